@@ -1,11 +1,532 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, simpledialog
 from PIL import Image, ImageTk
+import numpy as np
 import os
 import json
 import shutil
 import uuid
 import time
+import re
+import zlib
+import base64
+import random
+import fnmatch
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+    import fcntl
+
+# `gene_name={` at the start of a DNA line, and quoted template names such as "chin_forward_pos"
+GENE_NAME_RE = re.compile(r'^\s*([\w_]+)\s*=\s*\{', re.MULTILINE)
+GENE_TEMPLATE_RE = re.compile(r'"([^"]+)"')
+# Two-slot gene entry: `name={ "dominant_tmpl" 128 "recessive_tmpl" 128 }`, colors use plain numbers instead of templates
+HOMOGENIZE_RE = re.compile(r'^(\s*[\w_]+\s*=\s*\{\s*)("[^"]+"|\d+)\s+(\d+)\s+("[^"]+"|\d+)\s+(\d+)\s*(\})', re.MULTILINE)
+GENE_ENTRY_RE = re.compile(r'^(\s*)([\w_]+)(\s*=\s*\{\s*)("[^"]+"|\d+)\s+(\d+)\s+("[^"]+"|\d+)\s+(\d+)\s*\}', re.MULTILINE)
+
+# Batches smaller than this run inline, worker start-up would cost more than it saves
+BATCH_PROCESS_THRESHOLD = 200
+BATCH_CHUNK_SIZE = 100
+
+
+def homogenize_text(text):
+    """Copy the dominant gene slot over the recessive one."""
+    return HOMOGENIZE_RE.sub(lambda m: f"{m.group(1)}{m.group(2)} {m.group(3)} {m.group(2)} {m.group(3)} {m.group(6)}", text)
+
+
+def gene_entries(text):
+    """Map gene name -> full entry text for every two-slot gene in a DNA."""
+    return {m.group(2): m.group(0).strip() for m in GENE_ENTRY_RE.finditer(text)}
+
+
+def transform_dna(text, ops, salt=""):
+    """Apply batch operations in order. Each op is a tuple:
+    ("homogenize",), ("clamp", pattern, lo, hi), ("randomize", pattern, lo, hi, seed), ("copy", pattern, entries)
+    where pattern is a gene name glob and entries comes from gene_entries() of the template DNA."""
+    for op in ops:
+        kind = op[0]
+        if kind == "homogenize":
+            text = homogenize_text(text)
+            continue
+        pattern = op[1]
+        if kind == "randomize":
+            rng = random.Random(f"{op[4]}:{salt}")
+        def repl(m):
+            indent, name, eq = m.group(1), m.group(2), m.group(3)
+            if not fnmatch.fnmatchcase(name, pattern):
+                return m.group(0)
+            if kind == "copy":
+                return indent + op[2][name] if name in op[2] else m.group(0)
+            fields = list(m.group(4, 5, 6, 7))
+            for i, f in enumerate(fields):
+                if f.isdigit():
+                    if kind == "clamp":
+                        fields[i] = str(max(op[2], min(int(f), op[3])))
+                    else:
+                        fields[i] = str(rng.randint(op[2], op[3]))
+            return f"{indent}{name}{eq}{' '.join(fields)} }}"
+        text = GENE_ENTRY_RE.sub(repl, text)
+    return text
+
+
+def transform_chunk(chunk, ops):
+    # Worker entry point: chunk is [(key, dna)], returns [(key, new_dna)]
+    return [(key, transform_dna(text, ops, salt=key)) for key, text in chunk]
+
+
+# Search box sections: leading name text, then `tag:`/`tags:` and `gene:` clauses
+SEARCH_KEYWORD_RE = re.compile(r'\b(tags?|gene)\s*:')
+# Just enough of a gene entry to read its dominant value
+GENE_VALUE_RE = re.compile(r'^\s*(\w+)\s*=\s*\{\s*("[^"]+"|\d+)\s+(\d+)', re.MULTILINE)
+GENE_CONDITION_RE = re.compile(r'^(\w+)\s*(?:(>=|<=|>|<|==|=)\s*(\d+)|in\s+(\d+)\s*\.\.\s*(\d+))$')
+# DNA edits touching more characters than this fraction of a gallery rebuild its gene index instead
+GENE_INDEX_REBUILD_FRACTION = 0.1
+# ...but never for fewer than this many, or single edits in small galleries would drop it on every keystroke
+GENE_INDEX_REBUILD_MIN = 50
+
+
+def gene_values(text):
+    """Map gene name -> dominant value for every two-slot gene in a DNA (the first number for color genes)."""
+    return {gene: int(first if first[0] != '"' else value) for gene, first, value in GENE_VALUE_RE.findall(text)}
+
+
+def parse_gene_condition(text):
+    """`gene_chin_forward>200` or `skin_color in 10..40` -> (gene, lo, hi) inclusive; None while still being typed."""
+    m = GENE_CONDITION_RE.match(text)
+    if not m:
+        return None
+    if m.group(2) is None:
+        lo, hi = sorted((int(m.group(4)), int(m.group(5))))
+        return (m.group(1), lo, hi)
+    op, v = m.group(2), int(m.group(3))
+    if op == ">":
+        return (m.group(1), v + 1, float("inf"))
+    if op == ">=":
+        return (m.group(1), v, float("inf"))
+    if op == "<":
+        return (m.group(1), float("-inf"), v - 1)
+    if op == "<=":
+        return (m.group(1), float("-inf"), v)
+    return (m.group(1), v, v)
+
+
+def parse_search(text):
+    """Split a search box query into name text, tags and gene conditions,
+    e.g. `ann tag: noble gene: gene_chin_forward>200, skin_color in 10..40`."""
+    parts = SEARCH_KEYWORD_RE.split(text.lower())
+    query = {"name": parts[0].strip(), "tags": [], "genes": []}
+    for key, body in zip(parts[1::2], parts[2::2]):
+        items = [t.strip() for t in body.split(',') if t.strip()]
+        if key == "gene":
+            query["genes"] += [c for c in map(parse_gene_condition, items) if c]
+        else:
+            query["tags"] += items
+    return query
+
+
+class GeneIndex:
+    """Per-gene value columns for one gallery, kept sorted so range queries are a pair of binary searches."""
+    def __init__(self):
+        self.ids = []      # row -> char id (None once removed)
+        self.rows = {}     # char id -> row
+        self.genes = {}    # row -> {gene: value} as last indexed
+        self.dna = {}      # row -> DNA text as last indexed
+        self.columns = {}  # gene -> [values, rows], numpy arrays sorted by value
+
+    @classmethod
+    def build(cls, pairs):
+        """Bulk-index (char id, dna) pairs."""
+        index = cls()
+        per_gene = {}
+        for cid, dna in pairs:
+            row = index._add_row(cid)
+            index.genes[row] = gene_values(dna)
+            index.dna[row] = dna
+            for gene, value in index.genes[row].items():
+                vals, rows = per_gene.setdefault(gene, ([], []))
+                vals.append(value)
+                rows.append(row)
+        for gene, (vals, rows) in per_gene.items():
+            vals, rows = np.array(vals), np.array(rows)
+            order = np.argsort(vals, kind="stable")
+            index.columns[gene] = [vals[order], rows[order]]
+        return index
+
+    def _add_row(self, cid):
+        row = len(self.ids)
+        self.ids.append(cid)
+        self.rows[cid] = row
+        return row
+
+    def _insert(self, gene, value, row):
+        col = self.columns.setdefault(gene, [np.array([], dtype=int), np.array([], dtype=int)])
+        pos = np.searchsorted(col[0], value)
+        col[0] = np.insert(col[0], pos, value)
+        col[1] = np.insert(col[1], pos, row)
+
+    def _remove(self, gene, value, row):
+        col = self.columns[gene]
+        lo, hi = np.searchsorted(col[0], value, "left"), np.searchsorted(col[0], value, "right")
+        pos = lo + int(np.flatnonzero(col[1][lo:hi] == row)[0])
+        col[0] = np.delete(col[0], pos)
+        col[1] = np.delete(col[1], pos)
+
+    def update(self, cid, dna):
+        """Re-index one character, touching only the genes whose value changed."""
+        row = self.rows.get(cid)
+        if row is None:
+            row = self._add_row(cid)
+            old = {}
+        elif self.dna[row] == dna:
+            return
+        else:
+            old = self.genes[row]
+        new = gene_values(dna)
+        for gene, value in old.items():
+            if new.get(gene) != value:
+                self._remove(gene, value, row)
+        for gene, value in new.items():
+            if old.get(gene) != value:
+                self._insert(gene, value, row)
+        self.genes[row] = new
+        self.dna[row] = dna
+
+    def remove(self, cid):
+        row = self.rows.pop(cid, None)
+        if row is None:
+            return
+        for gene, value in self.genes.pop(row).items():
+            self._remove(gene, value, row)
+        del self.dna[row]
+        self.ids[row] = None
+
+    def query(self, conditions):
+        """Char ids matching every (gene, lo, hi) condition."""
+        hits = None
+        for gene, lo, hi in conditions:
+            col = self.columns.get(gene)
+            if col is None:
+                return set()
+            rows = col[1][np.searchsorted(col[0], lo, "left"):np.searchsorted(col[0], hi, "right")]
+            hits = rows if hits is None else np.intersect1d(hits, rows, assume_unique=True)
+        return {self.ids[r] for r in hits.tolist()}
+
+
+# How often to look for changes written by other instances sharing the data directory
+EXTERNAL_POLL_MS = 2000
+# Trash folders without an owner lock (left by older versions) are swept after this many seconds
+TRASH_MAX_AGE = 7 * 24 * 3600
+# Unreferenced images younger than this may belong to another instance's portrait save in progress
+ORPHAN_MIN_AGE = 60
+
+# Gallery undo history is capped by the estimated size of its deltas
+UNDO_MEMORY_LIMIT = 16 * 1024 * 1024
+# Journaled ops before they are folded into a full rewrite of galleries.json
+JOURNAL_LIMIT = 1000
+
+
+def gallery_position(galleries, gid):
+    return next((i for i, g in enumerate(galleries) if g.get("id") == gid), None)
+
+
+def assign_gallery_ids(galleries):
+    # Files written before galleries carried ids get positional ones, the same in every instance reading them
+    for i, g in enumerate(galleries):
+        g.setdefault("id", f"gallery-{i}")
+
+
+def apply_gallery_ops(galleries, ops):
+    """Apply change ops to galleries in place. The same ops serve as undo/redo deltas and journal lines:
+    set {g, items: [[id, fields]]}, order {g, ids}, move {g, id, dst}, delete {g, ids}, insert {g, items: [[index, char]]},
+    gallery {g, fields}, drop_gallery {g}, add_gallery {at, gallery}; g is the gallery id, so ops stay valid
+    when another instance adds or removes galleries before them."""
+    for op in ops:
+        kind = op["op"]
+        if kind == "add_gallery":
+            # Re-applied after merging another instance's changes, it may already be there
+            if gallery_position(galleries, op["gallery"]["id"]) is None:
+                galleries.insert(min(op["at"], len(galleries)), op["gallery"])
+            continue
+        pos = gallery_position(galleries, op["g"])
+        if pos is None:
+            # Deleted by another instance meanwhile
+            continue
+        if kind == "drop_gallery":
+            del galleries[pos]
+            continue
+        g = galleries[pos]
+        if kind == "gallery":
+            g.update(op["fields"])
+            continue
+        chars = g["characters"]
+        if kind == "insert":
+            present = {c.get("id") for c in chars}
+            for index, char in op["items"]:
+                if char.get("id") not in present:
+                    chars.insert(index, char)
+            continue
+        by_id = {c.get("id"): c for c in chars}
+        if kind == "set":
+            for cid, fields in op["items"]:
+                char = by_id.get(cid)
+                if char is not None:
+                    if "dna" in fields:
+                        char.pop("dna_z", None)
+                    char.update(fields)
+        elif kind == "order":
+            ids = set(op["ids"])
+            chars[:] = [by_id[i] for i in op["ids"] if i in by_id] + [c for c in chars if c.get("id") not in ids]
+        elif kind == "move":
+            char = by_id.get(op["id"])
+            if char is not None:
+                chars.remove(char)
+                chars.insert(op["dst"], char)
+        elif kind == "delete":
+            ids = set(op["ids"])
+            chars[:] = [c for c in chars if c.get("id") not in ids]
+
+
+def record_signature(char):
+    # Every edit bumps "modified"; name and image cover undo, which restores an older stamp
+    return (char.get("modified"), char.get("name"), char.get("image"))
+
+
+def merge_galleries(local, external, signatures=None):
+    """Bring local galleries in line with external in place. Galleries are matched by id, characters by id.
+    Unchanged dicts are reused so references to them stay valid. signatures maps id(char) to the signature
+    to compare against in place of the record's own, for records carrying unsaved edits.
+    Returns the (gallery, char) records that were replaced or added."""
+    signatures = signatures or {}
+    by_id = {g.get("id"): g for g in local}
+    unclaimed = {id(g) for g in local}
+    changed, merged = [], []
+    for eg in external:
+        lg = by_id.get(eg.get("id"))
+        if lg is None or id(lg) not in unclaimed:
+            merged.append(eg)
+            changed.extend((eg, c) for c in eg["characters"])
+            continue
+        unclaimed.discard(id(lg))
+        for key, value in eg.items():
+            if key != "characters":
+                lg[key] = value
+        local_chars = {c.get("id"): c for c in lg["characters"]}
+        chars = []
+        for ec in eg["characters"]:
+            lc = local_chars.get(ec.get("id"))
+            if lc is None:
+                chars.append(ec)
+                changed.append((lg, ec))
+                continue
+            if signatures.get(id(lc), record_signature(lc)) != record_signature(ec):
+                lc.clear()
+                lc.update(ec)
+                changed.append((lg, lc))
+            chars.append(lc)
+        lg["characters"][:] = chars
+        merged.append(lg)
+    local[:] = merged
+    return changed
+
+
+class FileLock:
+    """Re-entrant advisory lock on a sidecar file, shared by every instance using the same data directory.
+    A non-blocking lock raises OSError instead of waiting when another process holds it."""
+    def __init__(self, path, blocking=True):
+        self.path = path
+        self.blocking = blocking
+        self.depth = 0
+        self.handle = None
+
+    def __enter__(self):
+        if self.depth == 0:
+            self.handle = open(self.path, 'a+')
+            try:
+                if msvcrt:
+                    self.handle.seek(0)
+                    # LK_LOCK retries for about 10 seconds before raising OSError
+                    msvcrt.locking(self.handle.fileno(), msvcrt.LK_LOCK if self.blocking else msvcrt.LK_NBLCK, 1)
+                else:
+                    fcntl.flock(self.handle.fileno(), fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self.handle.close()
+                self.handle = None
+                raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0:
+            if msvcrt:
+                self.handle.seek(0)
+                msvcrt.locking(self.handle.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(self.handle.fileno(), fcntl.LOCK_UN)
+            self.handle.close()
+            self.handle = None
+
+
+def estimate_size(obj):
+    """Rough in-memory byte count of a delta, for the undo memory cap."""
+    if isinstance(obj, str):
+        return 49 + len(obj)
+    if isinstance(obj, dict):
+        return 64 + sum(estimate_size(k) + estimate_size(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return 56 + sum(8 + estimate_size(v) for v in obj)
+    return 24
+
+
+# Perceptual hash: 32x32 grayscale -> 2D DCT -> sign of the 8x8 low frequencies against their median
+PHASH_SIZE = 32
+PHASH_LOW = 8
+# Max differing bits (of 64) for two portraits to count as near-duplicates
+PHASH_THRESHOLD = 10
+_n = np.arange(PHASH_SIZE)
+DCT_MATRIX = np.sqrt(2 / PHASH_SIZE) * np.cos(np.pi * (2 * _n[None, :] + 1) * _n[:, None] / (2 * PHASH_SIZE))
+DCT_MATRIX[0] /= np.sqrt(2)
+POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def portrait_pixels(img):
+    return np.asarray(img.convert("L").resize((PHASH_SIZE, PHASH_SIZE), Image.Resampling.LANCZOS), dtype=np.float32)
+
+
+def phash_stack(pixels):
+    """Hash an (N, 32, 32) stack of grayscale images at once, returns N uint64 hashes."""
+    coeffs = DCT_MATRIX @ pixels @ DCT_MATRIX.T
+    low = coeffs[:, :PHASH_LOW, :PHASH_LOW].reshape(len(pixels), -1)
+    # The DC term only carries overall brightness, keep it out of the median
+    bits = low > np.median(low[:, 1:], axis=1)[:, None]
+    return np.packbits(bits, axis=1).view(">u8").ravel()
+
+
+def portrait_hash(img):
+    return int(phash_stack(portrait_pixels(img)[None])[0])
+
+
+def scan_portrait_hashes(images_dir, cache):
+    """Return {filename: [mtime, hash hex]} for every image in images_dir, rehashing only files whose mtime changed."""
+    result, stale = {}, []
+    if os.path.isdir(images_dir):
+        with os.scandir(images_dir) as it:
+            for entry in it:
+                if not entry.is_file() or not entry.name.lower().endswith(".png"):
+                    continue
+                mtime = entry.stat().st_mtime
+                cached = cache.get(entry.name)
+                if cached and cached[0] == mtime:
+                    result[entry.name] = cached
+                else:
+                    stale.append((entry.name, entry.path, mtime))
+    loaded = []
+    for name, path, mtime in stale:
+        try:
+            with Image.open(path) as img:
+                loaded.append((name, mtime, portrait_pixels(img)))
+        except OSError:
+            continue
+    if loaded:
+        hashes = phash_stack(np.stack([px for _, _, px in loaded]))
+        for (name, mtime, _), h in zip(loaded, hashes):
+            result[name] = [mtime, f"{int(h):016x}"]
+    return result
+
+
+def scan_images(images_dir):
+    """Index images_dir in one pass: {filename: (size, mtime)}."""
+    index = {}
+    if os.path.isdir(images_dir):
+        with os.scandir(images_dir) as it:
+            for entry in it:
+                if entry.is_file():
+                    st = entry.stat()
+                    index[entry.name] = (st.st_size, st.st_mtime)
+    return index
+
+
+def hamming_distances(hash_value, hashes):
+    """Bit distance from one hash to an array of uint64 hashes."""
+    xor = np.asarray(hashes, dtype=np.uint64) ^ np.uint64(hash_value)
+    return POPCOUNT8[xor.view(np.uint8)].reshape(len(xor), 8).sum(axis=1)
+
+
+def duplicate_clusters(hashes, threshold=PHASH_THRESHOLD, block=256):
+    """Group keys of {key: uint64 hash} whose hashes are within threshold bits of each other."""
+    keys = list(hashes)
+    values = np.array([hashes[k] for k in keys], dtype=np.uint64)
+    parent = list(range(len(keys)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # Compare in row blocks so memory stays at block x N instead of N x N
+    for start in range(0, len(keys), block):
+        xor = values[start:start + block, None] ^ values[None, :]
+        dist = POPCOUNT8[xor.view(np.uint8)].reshape(xor.shape[0], len(keys), 8).sum(axis=2)
+        for i, j in zip(*np.nonzero(dist <= threshold)):
+            i += start
+            if i < j:
+                parent[find(i)] = find(j)
+    groups = {}
+    for i, key in enumerate(keys):
+        groups.setdefault(find(i), []).append(key)
+    return [g for g in groups.values() if len(g) > 1]
+
+
+
+class DnaCodec:
+    """Compact on-disk DNA encoding: per-record zlib streams primed with a shared gene vocabulary."""
+    def __init__(self, vocabulary=()):
+        self.vocabulary = list(vocabulary)
+        self._known = set(self.vocabulary)
+        # Most frequent strings go last, zlib matches the end of a preset dictionary cheapest
+        zdict = "".join(f'{w}={{ "{w}" ' for w in self.vocabulary).encode('utf-8')
+        self._zdict = zdict[-32768:]
+        self._cache = {}  # dna text -> encoded blob, so unchanged records aren't recompressed
+
+    @staticmethod
+    def tokens(text):
+        return set(GENE_NAME_RE.findall(text)) | set(GENE_TEMPLATE_RE.findall(text))
+
+    def covers(self, text):
+        return text in self._cache or self.tokens(text) <= self._known
+
+    def encode(self, text):
+        blob = self._cache.get(text)
+        if blob is None:
+            comp = zlib.compressobj(9, zdict=self._zdict) if self._zdict else zlib.compressobj(9)
+            blob = base64.b64encode(comp.compress(text.encode('utf-8')) + comp.flush()).decode('ascii')
+            self._cache[text] = blob
+        return blob
+
+    def decode(self, blob):
+        decomp = zlib.decompressobj(zdict=self._zdict) if self._zdict else zlib.decompressobj()
+        text = (decomp.decompress(base64.b64decode(blob)) + decomp.flush()).decode('utf-8')
+        self._cache[text] = blob
+        return text
+
+    def retain(self, texts):
+        # Drop cache entries for DNA that has since been edited away
+        self._cache = {t: b for t, b in self._cache.items() if t in texts}
+
+    @classmethod
+    def from_texts(cls, texts):
+        counts = {}
+        for text in texts:
+            for tok in cls.tokens(text):
+                counts[tok] = counts.get(tok, 0) + 1
+        return cls(sorted(counts, key=lambda t: (counts[t], t)))
+
 
 class ImageCropper(tk.Toplevel):
     """Modal dialog for cropping/repositioning images with zoom selection."""
@@ -139,6 +660,128 @@ class ImageCropper(tk.Toplevel):
         self.destroy()
 
 
+class BatchTransformDialog(tk.Toplevel):
+    """Modal dialog for choosing a batch DNA operation and the characters it applies to."""
+    OPERATIONS = ["Homogenize", "Clamp values", "Randomize values", "Copy gene from template"]
+
+    def __init__(self, parent, char_names, has_selection):
+        super().__init__(parent)
+        self.title("Batch DNA Transform")
+        self.configure(bg="#2e2e2e")
+        self.transient(parent)
+        self.grab_set()
+
+        self.result = None
+        self.parent = parent
+
+        form = tk.Frame(self, bg="#2e2e2e")
+        form.pack(padx=10, pady=10)
+
+        ttk.Label(form, text="Apply to:").grid(row=0, column=0, sticky="w", pady=2)
+        self.scope_var = tk.StringVar(value="selected" if has_selection else "gallery")
+        scope_frame = tk.Frame(form, bg="#2e2e2e")
+        scope_frame.grid(row=0, column=1, sticky="w")
+        for text, value in (("Selected", "selected"), ("Gallery", "gallery"), ("All galleries", "all")):
+            rb = tk.Radiobutton(scope_frame, text=text, value=value, variable=self.scope_var,
+                                bg="#2e2e2e", fg="#dddddd", selectcolor="#1e1e1e", activebackground="#2e2e2e")
+            rb.pack(side="left")
+            if value == "selected" and not has_selection:
+                rb.config(state="disabled")
+
+        ttk.Label(form, text="Operation:").grid(row=1, column=0, sticky="w", pady=2)
+        self.op_var = tk.StringVar(value=self.OPERATIONS[0])
+        ttk.Combobox(form, textvariable=self.op_var, values=self.OPERATIONS, state="readonly", width=30)\
+            .grid(row=1, column=1, sticky="w")
+
+        ttk.Label(form, text="Genes (e.g. gene_chin_*):").grid(row=2, column=0, sticky="w", pady=2)
+        self.gene_var = tk.StringVar(value="*")
+        ttk.Entry(form, textvariable=self.gene_var, width=32).grid(row=2, column=1, sticky="w")
+
+        ttk.Label(form, text="Min / Max:").grid(row=3, column=0, sticky="w", pady=2)
+        range_frame = tk.Frame(form, bg="#2e2e2e")
+        range_frame.grid(row=3, column=1, sticky="w")
+        self.lo_var = tk.StringVar(value="0")
+        self.hi_var = tk.StringVar(value="255")
+        ttk.Entry(range_frame, textvariable=self.lo_var, width=6).pack(side="left")
+        ttk.Entry(range_frame, textvariable=self.hi_var, width=6).pack(side="left", padx=5)
+
+        ttk.Label(form, text="Template character:").grid(row=4, column=0, sticky="w", pady=2)
+        self.template_var = tk.StringVar()
+        self.template_box = ttk.Combobox(form, textvariable=self.template_var, values=char_names, state="readonly", width=30)
+        self.template_box.grid(row=4, column=1, sticky="w")
+
+        btn_frame = tk.Frame(self, bg="#2e2e2e")
+        btn_frame.pack(pady=10)
+        ttk.Button(btn_frame, text="Apply", command=self.ok, width=10).pack(side="left", padx=5)
+        ttk.Button(btn_frame, text="Cancel", command=self.cancel, width=10).pack(side="left", padx=5)
+
+    def ok(self):
+        op = self.op_var.get()
+        pattern = self.gene_var.get().strip() or "*"
+        if op == "Homogenize":
+            ops = [("homogenize",)]
+        elif op == "Copy gene from template":
+            # By position, names need not be unique
+            index = self.template_box.current()
+            if index < 0:
+                messagebox.showwarning("Warning", "Please choose a template character.", parent=self)
+                return
+            template = self.parent.current_gallery["characters"][index]
+            ops = [("copy", pattern, gene_entries(self.parent.get_dna(template)))]
+        else:
+            try:
+                lo, hi = sorted((int(self.lo_var.get()), int(self.hi_var.get())))
+            except ValueError:
+                messagebox.showwarning("Warning", "Min and Max must be whole numbers.", parent=self)
+                return
+            if op == "Clamp values":
+                ops = [("clamp", pattern, lo, hi)]
+            else:
+                ops = [("randomize", pattern, lo, hi, uuid.uuid4().hex)]
+        self.result = (self.scope_var.get(), ops)
+        self.destroy()
+
+    def cancel(self):
+        self.result = None
+        self.destroy()
+
+
+class ConflictDialog(tk.Toplevel):
+    """Modal dialog listing characters another instance changed while they had unsaved edits here."""
+    def __init__(self, parent, conflicts):
+        super().__init__(parent)
+        self.title("Conflicting Changes")
+        self.geometry("600x350")
+        self.configure(bg="#2e2e2e")
+        self.transient(parent)
+        self.grab_set()
+
+        self.result = None
+        self.conflicts = conflicts
+
+        ttk.Label(self, text="Another instance changed these characters too. Your version was kept.\n"
+                             "Select any to replace with the other version instead.").pack(pady=10)
+        self.listbox = tk.Listbox(self, bg="#1e1e1e", fg="#eeeeee", font=("Arial", 10),
+                                  selectmode="extended", highlightthickness=0)
+        self.listbox.pack(fill="both", expand=True, padx=10)
+        for c in conflicts:
+            what = "deleted" if c["theirs"] is None else "edited"
+            self.listbox.insert(tk.END, f"{c['char'].get('name', '')} ({c['gallery']['name']}): {what} elsewhere")
+
+        btn_frame = tk.Frame(self, bg="#2e2e2e")
+        btn_frame.pack(pady=10)
+        ttk.Button(btn_frame, text="Use Theirs for Selected", command=self.ok, width=24).pack(side="left", padx=5)
+        ttk.Button(btn_frame, text="Keep Mine", command=self.cancel, width=12).pack(side="left", padx=5)
+
+    def ok(self):
+        self.result = [self.conflicts[i] for i in self.listbox.curselection()]
+        self.destroy()
+
+    def cancel(self):
+        self.result = None
+        self.destroy()
+
+
 class CharacterGallery(tk.Tk):
     def __init__(self):
         super().__init__()
@@ -151,18 +794,56 @@ class CharacterGallery(tk.Tk):
         self.data_file = os.path.join(self.data_dir, "galleries.json")
         os.makedirs(self.data_dir, exist_ok=True)
 
+        # Changes since the last full save are appended to a journal and replayed on load
+        self.journal_file = os.path.join(self.data_dir, "galleries.journal")
+        # Other instances may share the data directory: every read-check-write happens under this lock
+        self.lock = FileLock(os.path.join(self.data_dir, "galleries.lock"))
+        # Unsaved DNA/tag edits, with the values they replaced: {id(char): {char, gallery, base}}
+        self.pending = {}
+
         # Load or initialize galleries: list of dicts {name, characters:list}
-        if os.path.exists(self.data_file):
-            with open(self.data_file, 'r', encoding='utf-8') as f:
-                self.galleries = json.load(f)
-        else:
-            self.galleries = [{"name":"Default","characters":[]}]
+        with self.lock:
+            self.load_store(self.read_store())
 
         # Current state
         self.current_gallery = None
         self.current_index = None
+        # Characters behind the listbox rows, fewer than the gallery's while a search filter is active
+        self.listed_chars = []
         # Track unsaved changes
         self.dirty = False
+        # Running batch DNA transform
+        self.batch_job = None
+        # Gene search indexes, built on first `gene:` query: {id(gallery): (gallery, GeneIndex)}
+        self.gene_indexes = {}
+        # Gallery-level undo/redo deltas, see record(). Trashed portraits wait in trash_dir until their delta is dropped
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.history_bytes = 0
+        trash_root = os.path.join(self.data_dir, "trash")
+        self.trash_dir = os.path.join(trash_root, uuid.uuid4().hex)
+        os.makedirs(self.trash_dir)
+        # Held while this instance runs, so the others can tell its trash is still in use
+        self.trash_lock = FileLock(os.path.join(self.trash_dir, "owner.lock"))
+        self.trash_lock.__enter__()
+        with os.scandir(trash_root) as it:
+            for entry in it:
+                if entry.is_dir() and entry.path != self.trash_dir and self.trash_abandoned(entry.path):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+        # Perceptual hashes of portraits, cached by mtime: {filename: [mtime, hash hex]}
+        self.hash_cache_file = os.path.join(self.data_dir, "portrait_hashes.json")
+        self.portrait_hashes = {}
+        self.portrait_scan = None
+        # Filenames present in the images directory, filled by the integrity scan: {filename: size}
+        self.images_dir = os.path.join(self.data_dir, "images")
+        self.image_index = None
+        self.integrity_scan = None
+        if os.path.exists(self.hash_cache_file):
+            try:
+                with open(self.hash_cache_file, 'r', encoding='utf-8') as f:
+                    self.portrait_hashes = json.load(f)
+            except (OSError, ValueError):
+                pass
         # Override close button
         self.protocol("WM_DELETE_WINDOW", self.on_close)
 
@@ -179,6 +860,11 @@ class CharacterGallery(tk.Tk):
         self.dna_text.config(undo=True, autoseparators=True, maxundo=-1)
         self.dna_text.bind("<Control-z>", lambda e: self.dna_text.edit_undo())
         self.dna_text.bind("<Control-Z>", lambda e: self.dna_text.edit_undo())
+        # Ctrl+Z/Ctrl+Y elsewhere undo/redo gallery changes
+        self.bind_all("<Control-z>", lambda e: self.on_history_key(self.undo))
+        self.bind_all("<Control-Z>", lambda e: self.on_history_key(self.undo))
+        self.bind_all("<Control-y>", lambda e: self.on_history_key(self.redo))
+        self.bind_all("<Control-Y>", lambda e: self.on_history_key(self.redo))
         # Enable Ctrl+V to paste image from clipboard
         self.bind_all("<Control-v>", lambda e: self.paste_from_clipboard())
         self.bind_all("<Control-V>", lambda e: self.paste_from_clipboard())
@@ -204,6 +890,11 @@ class CharacterGallery(tk.Tk):
         )
         self.status_label.pack(side="bottom", fill="x", padx=5, pady=1)
 
+        # Refresh portrait hashes quietly so new portraits can be checked for duplicates
+        self.start_portrait_scan(report=False)
+        self.start_integrity_scan()
+        self.after(EXTERNAL_POLL_MS, self.poll_external_changes)
+
     def setup_ui(self):
         style = ttk.Style()
         style.theme_use('clam')
@@ -250,6 +941,16 @@ class CharacterGallery(tk.Tk):
         sort_sub.add_command(label="Created ↓", command=lambda: self.sort_characters("created_desc"))
         sort_sub.add_command(label="Modified ↓", command=lambda: self.sort_characters("modified_desc"))
         menu.add_cascade(label="Sort Characters", menu=sort_sub)
+        menu.add_separator()
+        menu.add_command(label="Batch DNA Transform...", command=self.open_batch_transform)
+        menu.add_command(label="Undo", command=self.undo)
+        menu.add_command(label="Redo", command=self.redo)
+        menu.add_command(label="Find Duplicate Portraits", command=self.start_portrait_scan)
+        menu.add_command(label="Check Storage Integrity", command=self.start_integrity_scan)
+        menu.add_separator()
+        self.compact_var = tk.BooleanVar(value=self.compact_dna)
+        menu.add_checkbutton(label="Compact DNA Storage", variable=self.compact_var,
+                             command=self.toggle_compact_dna)
         menu_btn["menu"] = menu
         menu_btn.pack(side="left", padx=(2,5), pady=(2,0))
         menu_btn.configure(padding=(2, 0, 2, 0))  # left, top, right, bottom
@@ -380,6 +1081,8 @@ class CharacterGallery(tk.Tk):
                 return
             if resp:
                 self.save_current()
+        self.trash_lock.__exit__(None, None, None)
+        shutil.rmtree(self.trash_dir, ignore_errors=True)
         self.destroy()
 
     def paste_from_clipboard(self):
@@ -408,16 +1111,8 @@ class CharacterGallery(tk.Tk):
                 if cropper.result:
                     cropped = img.crop(cropper.result)
                     cropped = cropped.resize((450, 450), Image.Resampling.LANCZOS)
-                    char_id = self.current_gallery["characters"][self.current_index]['id']
-                    save_path = os.path.join(self.data_dir, "images", f"{char_id}.png")
-                    os.makedirs(os.path.dirname(save_path), exist_ok=True)
-                    cropped.save(save_path)
-                    self.current_gallery["characters"][self.current_index]['image'] = save_path
-                    self.current_gallery["characters"][self.current_index]["modified"] = time.time()
-                    self.dirty = True
-                    self.save_galleries()
-                    self.select_character(self.current_index)
-                    self.set_status("Portrait pasted successfully ✔️")
+                    if self.save_portrait(cropped):
+                        self.set_status("Portrait pasted successfully ✔️")
             # Clean up temp
             if temp_path and temp_path.endswith("temp_clipboard.png") and os.path.exists(temp_path):
                 os.remove(temp_path)
@@ -439,23 +1134,30 @@ class CharacterGallery(tk.Tk):
         old_name = self.current_gallery["characters"][idx]["name"]
         new_name = simpledialog.askstring("Rename Character", f"Enter new name for '{old_name}':", parent=self)
         if new_name and new_name != old_name:
-            self.current_gallery["characters"][idx]["name"] = new_name
-            self.current_gallery["characters"][idx]["modified"] = time.time()
-            self.dirty = True
-            self.save_galleries()
+            char = self.current_gallery["characters"][idx]
+            self.commit(
+                "rename",
+                [self.set_op(char, name=new_name, modified=time.time())],
+                [self.set_op(char, name=old_name, modified=char.get("modified"))]
+            )
             self.refresh_list()
             self.char_listbox.selection_set(idx)
             self.set_status(f"Character '{old_name}' renamed to '{new_name}' ✔️")
 
     def sort_characters(self, mode):
-        lst = self.current_gallery["characters"]
+        lst = list(self.current_gallery["characters"])
+        old_ids = [c.get("id") for c in lst]
         if mode=="name_asc": lst.sort(key=lambda c: c["name"].lower())
         elif mode=="name_desc": lst.sort(key=lambda c: c["name"].lower(), reverse=True)
         elif mode=="created_asc": lst.sort(key=lambda c: c.get("created",0))
         elif mode=="created_desc": lst.sort(key=lambda c: c.get("created",0), reverse=True)
         elif mode=="modified_desc": lst.sort(key=lambda c: c.get("modified",0), reverse=True)
-        self.dirty = True
-        self.save_galleries()
+        g = self.current_gallery["id"]
+        self.commit(
+            "sort",
+            [{"op": "order", "g": g, "ids": [c.get("id") for c in lst]}],
+            [{"op": "order", "g": g, "ids": old_ids}]
+        )
         self.refresh_list()
         self.set_status("Character entries sorted ✔️")
 
@@ -465,12 +1167,13 @@ class CharacterGallery(tk.Tk):
     def on_drop(self, event):
         dst = self.char_listbox.nearest(event.y)
         if dst!=self._drag_idx:
-            lst = self.current_gallery["characters"]
-            item = lst.pop(self._drag_idx)
-            lst.insert(dst, item)
-            self.current_gallery["characters"][dst]["modified"] = time.time()
-            self.dirty=True
-            self.save_galleries()
+            item = self.current_gallery["characters"][self._drag_idx]
+            g = self.current_gallery["id"]
+            self.commit(
+                "reorder",
+                [{"op": "move", "g": g, "id": item["id"], "dst": dst}, self.set_op(item, modified=time.time())],
+                [self.set_op(item, modified=item.get("modified")), {"op": "move", "g": g, "id": item["id"], "dst": self._drag_idx}]
+            )
             self.refresh_list()
             self.char_listbox.selection_set(dst)
 
@@ -481,9 +1184,12 @@ class CharacterGallery(tk.Tk):
             if not new_name:
                 self.gallery_var.set(self.current_gallery["name"])
                 return
-            self.galleries.append({"name":new_name,"characters":[]})
-            self.dirty = True
-            self.save_galleries()
+            gallery = {"id": uuid.uuid4().hex, "name": new_name, "characters": []}
+            self.commit(
+                "new gallery",
+                [{"op": "add_gallery", "at": len(self.galleries), "gallery": gallery}],
+                [{"op": "drop_gallery", "g": gallery["id"]}]
+            )
             self.gallery_box["values"] = [g["name"] for g in self.galleries]+["Create a new gallery..."]
             self.gallery_var.set(new_name)
             self.load_gallery(new_name)
@@ -495,10 +1201,12 @@ class CharacterGallery(tk.Tk):
         new_name = simpledialog.askstring("Rename Gallery",f"Enter new name for '{old_name}':",parent=self)
         if not new_name or new_name == old_name:
             return
-        self.current_gallery["name"] = new_name
-        self.current_gallery["modified"] = time.time()
-        self.dirty = True
-        self.save_galleries()
+        g = self.current_gallery["id"]
+        self.commit(
+            "gallery rename",
+            [{"op": "gallery", "g": g, "fields": {"name": new_name, "modified": time.time()}}],
+            [{"op": "gallery", "g": g, "fields": {"name": old_name, "modified": self.current_gallery.get("modified")}}]
+        )
         vals = [g["name"] for g in self.galleries]+["Create a new gallery..."]
         self.gallery_box["values"] = vals
         self.gallery_var.set(new_name)
@@ -511,15 +1219,18 @@ class CharacterGallery(tk.Tk):
         name = self.current_gallery["name"]
         if not messagebox.askyesno("Delete Gallery",f"Delete gallery '{name}' and all its characters?"):
             return
-        # Remove all image files for this gallery
+        # Records kept for undo must not depend on the DNA vocabulary, which a later save may replace
         for char in self.current_gallery["characters"]:
-            img = char.get("image")
-            if img and os.path.exists(img):
-                os.remove(img)
+            self.get_dna(char)
+        # Move the gallery's portraits to the trash, undo brings them back
+        files = self.trash_images(self.current_gallery["characters"])
         # Remove gallery entry
-        self.galleries.remove(self.current_gallery)
-        self.dirty = True
-        self.save_galleries()
+        self.commit(
+            "gallery deletion",
+            [{"op": "drop_gallery", "g": self.current_gallery["id"]}],
+            [{"op": "add_gallery", "at": self.gallery_index(), "gallery": self.current_gallery}],
+            files
+        )
         # Refresh dropdown and select first
         vals = [g["name"] for g in self.galleries] + ["Create a new gallery..."]
         self.gallery_box["values"] = vals
@@ -546,6 +1257,9 @@ class CharacterGallery(tk.Tk):
                 return
             shutil.rmtree(out_dir)
         os.makedirs(out_dir, exist_ok=True)
+        # Exports always carry plain-text DNA
+        for char in self.current_gallery["characters"]:
+            self.get_dna(char)
         # Save characters JSON
         with open(os.path.join(out_dir, "characters.json"), "w", encoding="utf-8") as f:
             json.dump(self.current_gallery["characters"], f, indent=2)
@@ -554,7 +1268,7 @@ class CharacterGallery(tk.Tk):
         os.makedirs(images_out, exist_ok=True)
         for char in self.current_gallery["characters"]:
             img = char.get("image")
-            if img and os.path.exists(img):
+            if self.image_exists(img):
                 shutil.copy2(img, os.path.join(images_out, os.path.basename(img)))
         messagebox.showinfo("Exported", f"Gallery '{name}' exported to {out_dir}")
 
@@ -572,7 +1286,8 @@ class CharacterGallery(tk.Tk):
         gallery_name = simpledialog.askstring("Import Gallery", "Enter name for imported gallery:", parent=self)
         if not gallery_name:
             return
-        new_gallery = {"name": gallery_name, "characters": []}
+        new_gallery = {"id": uuid.uuid4().hex, "name": gallery_name, "characters": []}
+        files = []
         # Create images dir in data_dir
         for char in chars:
             cid = char.get("id", str(uuid.uuid4()))
@@ -581,45 +1296,221 @@ class CharacterGallery(tk.Tk):
             if os.path.exists(src_img):
                 dest_img = os.path.join(self.data_dir, "images", f"{cid}.png")
                 os.makedirs(os.path.dirname(dest_img), exist_ok=True)
-                shutil.copy2(src_img, dest_img)
+                # A fresh mtime keeps other instances' storage checks from taking it for an old orphan before the commit
+                shutil.copy(src_img, dest_img)
+                self.index_image(dest_img)
+                files.append((os.path.join(self.trash_dir, f"{uuid.uuid4().hex}.png"), dest_img))
                 char['image'] = dest_img
             else:
                 char['image'] = None
             new_gallery["characters"].append(char)
-        self.galleries.append(new_gallery)
-        self.dirty = True
-        self.save_galleries()
+        self.commit(
+            "import",
+            [{"op": "add_gallery", "at": len(self.galleries), "gallery": new_gallery}],
+            [{"op": "drop_gallery", "g": new_gallery["id"]}],
+            files
+        )
         self.gallery_box["values"] = [g["name"] for g in self.galleries] + ["Create a new gallery..."]
         self.gallery_var.set(gallery_name)
         self.load_gallery(gallery_name)
         messagebox.showinfo("Imported", f"Gallery '{gallery_name}' imported successfully")
 
     def save_galleries(self):
-        with open(self.data_file,'w',encoding='utf-8') as f:
-            json.dump(self.galleries,f,indent=2)
+        with self.lock:
+            # Fold in what other instances wrote since we last looked, so their edits aren't overwritten
+            conflicts = self.sync_external()[1]
+            # Write to a temp file and swap it in, so a crash never leaves a half-written galleries.json
+            tmp_file = self.data_file + ".tmp"
+            with open(tmp_file,'w',encoding='utf-8') as f:
+                if self.compact_dna:
+                    json.dump(self.compact_payload(),f,separators=(',',':'))
+                else:
+                    for g in self.galleries:
+                        for char in g["characters"]:
+                            self.get_dna(char)
+                    json.dump(self.galleries,f,indent=2)
+            os.replace(tmp_file, self.data_file)
+            # Everything journaled is now in galleries.json
+            if os.path.exists(self.journal_file):
+                os.remove(self.journal_file)
+            self.journal_length = 0
+            self.journal_offset = 0
+            self.disk_stamp = self.data_file_stamp()
         self.dirty = False
+        self.pending.clear()
+        self.report_conflicts(conflicts)
+
+    def read_store(self):
+        """Read galleries.json and replay its journal."""
+        store = {"galleries": [{"id":"gallery-0","name":"Default","characters":[]}], "compact": False, "vocabulary": [],
+                 "stamp": None, "journal_length": 0, "journal_offset": 0}
+        if not os.path.exists(self.data_file):
+            return store
+        with open(self.data_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        # Compact files wrap the list: {dna_encoding, dna_vocabulary, galleries}
+        if isinstance(data, dict):
+            store["galleries"] = data["galleries"]
+            store["compact"] = data.get("dna_encoding") == "zlib"
+            store["vocabulary"] = data.get("dna_vocabulary", [])
+        else:
+            store["galleries"] = data
+        assign_gallery_ids(store["galleries"])
+        store["stamp"] = self.data_file_stamp()
+        ops, offset = self.read_journal(0, store["stamp"])
+        if ops is None:
+            # A journal written against an older galleries.json was already folded into it
+            os.remove(self.journal_file)
+            ops, offset = [], 0
+        apply_gallery_ops(store["galleries"], ops)
+        store["journal_length"], store["journal_offset"] = len(ops), offset
+        return store
+
+    def load_store(self, store):
+        self.galleries = store["galleries"]
+        self.compact_dna = store["compact"]
+        self.dna_codec = DnaCodec(store["vocabulary"])
+        self.disk_stamp = store["stamp"]
+        self.journal_length = store["journal_length"]
+        self.journal_offset = store["journal_offset"]
+
+    def compact_payload(self):
+        chars = [c for g in self.galleries for c in g["characters"]]
+        texts = {c["dna"] for c in chars if c.get("dna")}
+        if not all(self.dna_codec.covers(t) for t in texts):
+            # New genes widen the shared vocabulary, so every record is re-encoded against it
+            for char in chars:
+                self.get_dna(char)
+            texts = {c["dna"] for c in chars if c.get("dna")}
+            self.dna_codec = DnaCodec.from_texts(texts)
+        self.dna_codec.retain(texts)
+        galleries = []
+        for g in self.galleries:
+            out = []
+            for char in g["characters"]:
+                if char.get("dna"):
+                    dna = char["dna"]
+                    char = {k: v for k, v in char.items() if k != "dna"}
+                    char["dna_z"] = self.dna_codec.encode(dna)
+                out.append(char)
+            galleries.append(dict(g, characters=out))
+        return {"dna_encoding": "zlib", "dna_vocabulary": self.dna_codec.vocabulary, "galleries": galleries}
+
+    def get_dna(self, char):
+        # Compact records are decoded the first time they are needed
+        if "dna_z" in char:
+            char["dna"] = self.dna_codec.decode(char.pop("dna_z"))
+        return char.get("dna", "")
+
+    def toggle_compact_dna(self):
+        self.compact_dna = self.compact_var.get()
+        self.save_galleries()
+        state = "enabled" if self.compact_dna else "disabled"
+        self.set_status(f"Compact DNA storage {state} ✔️")
 
     def refresh_list(self):
         self.char_listbox.delete(0,tk.END)
-        for char in self.current_gallery["characters"]:
-            self.char_listbox.insert(tk.END,char.get("name",""))
+        self.listed_chars = list(self.current_gallery["characters"])
+        names = [char.get("name","") for char in self.listed_chars]
+        if names:
+            self.char_listbox.insert(tk.END,*names)
 
     def filter_list(self):
-        term = self.search_var.get().lower()
-        self.char_listbox.delete(0,tk.END)
-        # Check if tag search
-        if term.startswith(("tag:", "tags:")):
-            search_tags = [t.strip() for t in term.replace("tags:", "tag:", 1)[4:].split(',') if t.strip()]
-            for char in self.current_gallery["characters"]:
+        query = parse_search(self.search_var.get())
+        # Gene conditions come from the index, name and tag checks are cheap per character
+        matched = None
+        if query["genes"]:
+            index = self.gene_index()
+            if index is None:
+                # Listed once the background build finishes
+                self.char_listbox.delete(0,tk.END)
+                self.listed_chars = []
+                self.status_label.config(text="Indexing character genes...", fg="#FFD700")
+                return
+            matched = index.query(query["genes"])
+        listed = []
+        for char in self.current_gallery["characters"]:
+            if matched is not None and char.get("id") not in matched:
+                continue
+            if query["tags"]:
                 char_tags = [t.lower() for t in char.get('tags', [])]
-                if any(st in char_tags for st in search_tags):
-                    self.char_listbox.insert(tk.END,char.get("name",""))
-        else:
-            # Normal name search
-            for char in self.current_gallery["characters"]:
-                name = char.get("name","")
-                if term in name.lower():
-                    self.char_listbox.insert(tk.END,name)
+                if not any(st in char_tags for st in query["tags"]):
+                    continue
+            if query["name"] in char.get("name","").lower():
+                listed.append(char)
+        self.char_listbox.delete(0,tk.END)
+        self.listed_chars = listed
+        if listed:
+            self.char_listbox.insert(tk.END,*[char.get("name","") for char in listed])
+
+    def gene_index(self, gallery=None):
+        """Gene index of a gallery synced with added or removed characters, or None while it is built in the background."""
+        gallery = gallery or self.current_gallery
+        entry = self.gene_indexes.get(id(gallery))
+        if entry is None or entry[0] is not gallery:
+            self.start_gene_index_build(gallery)
+            return None
+        index = entry[1]
+        if index is None:
+            return None
+        chars = gallery["characters"]
+        present = {c["id"] for c in chars}
+        for cid in [cid for cid in index.rows if cid not in present]:
+            index.remove(cid)
+        for c in chars:
+            if c["id"] not in index.rows:
+                index.update(c["id"], self.get_dna(c))
+        return index
+
+    def start_gene_index_build(self, gallery):
+        pairs = [(c["id"], self.get_dna(c)) for c in gallery["characters"]]
+        job = {"index": None}
+
+        def work():
+            job["index"] = GeneIndex.build(pairs)
+
+        thread = threading.Thread(target=work, daemon=True)
+        self.gene_indexes[id(gallery)] = (gallery, None)
+        thread.start()
+
+        def poll():
+            if thread.is_alive():
+                self.after(100, poll)
+                return
+            entry = self.gene_indexes.get(id(gallery))
+            if entry is None or entry[0] is not gallery or job["index"] is None:
+                return
+            index = job["index"]
+            # Catch up with DNA edited while the build was running
+            for c in gallery["characters"]:
+                if c["id"] in index.rows:
+                    index.update(c["id"], self.get_dna(c))
+            self.gene_indexes[id(gallery)] = (gallery, index)
+            if gallery is self.current_gallery:
+                self.status_label.config(text="Idle", fg="#888888")
+                self.filter_list()
+
+        self.after(100, poll)
+
+    def reindex_dna(self, gallery, items):
+        """Keep an existing gene index current after DNA edits: items are (char id, new dna)."""
+        entry = self.gene_indexes.get(id(gallery))
+        if entry is None or entry[0] is not gallery or entry[1] is None:
+            return
+        if len(items) > max(GENE_INDEX_REBUILD_MIN, GENE_INDEX_REBUILD_FRACTION * len(gallery["characters"])):
+            # Cheaper to rebuild lazily on the next query
+            del self.gene_indexes[id(gallery)]
+            return
+        for cid, dna in items:
+            entry[1].update(cid, dna)
+
+    def reindex_ops(self, ops):
+        for op in ops:
+            if op["op"] == "set":
+                items = [(cid, fields["dna"]) for cid, fields in op["items"] if "dna" in fields]
+                gallery = self.gallery_by_id(op["g"])
+                if items and gallery is not None:
+                    self.reindex_dna(gallery, items)
 
     def on_select(self, event):
         selection = self.char_listbox.curselection()
@@ -633,8 +1524,14 @@ class CharacterGallery(tk.Tk):
 
             # Load portrait
             image_file = char.get('image')
-            if image_file and os.path.exists(image_file):
-                img = Image.open(image_file)
+            img = None
+            if self.image_exists(image_file):
+                try:
+                    img = Image.open(image_file)
+                except OSError:
+                    # Removed behind our back, the cached index was stale
+                    self.forget_image(image_file)
+            if img:
                 img = img.resize((450, 450), Image.Resampling.LANCZOS)
                 self.portrait_photo = ImageTk.PhotoImage(img)
 
@@ -650,7 +1547,7 @@ class CharacterGallery(tk.Tk):
 
             # Load DNA
             self.dna_text.delete("1.0", tk.END)
-            self.dna_text.insert("1.0", char.get('dna', ''))
+            self.dna_text.insert("1.0", self.get_dna(char))
             # Load tags
             self.tags_text.delete("1.0", tk.END)
             tags = char.get('tags', [])
@@ -670,9 +1567,12 @@ class CharacterGallery(tk.Tk):
             'created': time.time(),
             'modified': time.time()
         }
-        self.current_gallery["characters"].append(new_char)
-        self.dirty = True
-        self.save_galleries()
+        g = self.current_gallery["id"]
+        self.commit(
+            "new character",
+            [{"op": "insert", "g": g, "items": [[len(self.current_gallery["characters"]), new_char]]}],
+            [{"op": "delete", "g": g, "ids": [char_id]}]
+        )
         self.refresh_list()
         idx = len(self.current_gallery["characters"]) - 1
         self.char_listbox.selection_clear(0, tk.END)
@@ -686,27 +1586,25 @@ class CharacterGallery(tk.Tk):
             return
         if not messagebox.askyesno("Confirm", f"Delete {len(sel)} character(s)?"):
             return
-        # Remove files first
+        chars = self.current_gallery["characters"]
+        # Records kept for undo must not depend on the DNA vocabulary, which a later save may replace
         for idx in sel:
-            char = self.current_gallery["characters"][idx]
-            img = char.get("image")
-            if img and os.path.exists(img):
-                os.remove(img)
+            self.get_dna(chars[idx])
+        # Move files to the trash first, undo brings them back
+        files = self.trash_images([chars[idx] for idx in sel])
         # Now remove character entries
-        for idx in sorted(sel, reverse=True):
-            del self.current_gallery["characters"][idx]
-        self.dirty = True
-        self.save_galleries()
+        g = self.current_gallery["id"]
+        self.commit(
+            "deletion",
+            [{"op": "delete", "g": g, "ids": [chars[idx]["id"] for idx in sel]}],
+            [{"op": "insert", "g": g, "items": [[idx, chars[idx]] for idx in sorted(sel)]}],
+            files
+        )
         self.refresh_list()
         # Clear portrait and DNA if no entry selected
         remaining = self.char_listbox.curselection()
         if not remaining:
-            if self.portrait_image_id:
-                self.portrait_canvas.delete(self.portrait_image_id)
-            self.portrait_image_id = None
-            self.dna_text.delete("1.0", tk.END)
-            self.tags_text.delete("1.0", tk.END)
-            self.current_index = None
+            self.clear_character_view()
         else:
             self.select_character(remaining[0])
         self.set_status("Character entry deletion successful ✔️")
@@ -720,20 +1618,27 @@ class CharacterGallery(tk.Tk):
             'id': new_id,
             'name': char['name'] + " (Copy)",
             'image': None,
-            'dna': char['dna'],
+            'dna': self.get_dna(char),
             'tags': char.get('tags', []).copy(),
             'created': time.time(),
             'modified': time.time()
         }
         # Copy image if exists
-        if char.get('image') and os.path.exists(char['image']):
+        files = []
+        if self.image_exists(char.get('image')):
             old_img = char['image']
             new_img = os.path.join(self.data_dir, "images", f"{new_id}.png")
-            shutil.copy2(old_img, new_img)
+            shutil.copy(old_img, new_img)
+            self.index_image(new_img)
+            files.append((os.path.join(self.trash_dir, f"{uuid.uuid4().hex}.png"), new_img))
             dup_char['image'] = new_img
-        self.current_gallery["characters"].append(dup_char)
-        self.dirty = True
-        self.save_galleries()
+        g = self.current_gallery["id"]
+        self.commit(
+            "duplicate",
+            [{"op": "insert", "g": g, "items": [[len(self.current_gallery["characters"]), dup_char]]}],
+            [{"op": "delete", "g": g, "ids": [new_id]}],
+            files
+        )
         self.refresh_list()
         idx = len(self.current_gallery["characters"]) - 1
         self.char_listbox.selection_clear(0, tk.END)
@@ -763,31 +1668,274 @@ class CharacterGallery(tk.Tk):
                 cropped = cropped.resize((450, 450), Image.Resampling.LANCZOS)
 
                 # Save to data directory
-                char_id = self.current_gallery["characters"][self.current_index]['id']
-                save_path = os.path.join(self.data_dir, "images", f"{char_id}.png")
-                os.makedirs(os.path.dirname(save_path), exist_ok=True)
-                cropped.save(save_path)
-
-                self.current_gallery["characters"][self.current_index]['image'] = save_path
-                self.current_gallery["characters"][self.current_index]['modified'] = time.time()
-                self.dirty = True
-                self.save_galleries()
+                if self.save_portrait(cropped):
+                    self.set_status("Portrait updated successfully ✔️")
+
+    def save_portrait(self, cropped):
+        """Save a cropped portrait for the current character, returns False if the user skips a near-duplicate."""
+        char = self.current_gallery["characters"][self.current_index]
+        filename = f"{char['id']}.png"
+        phash = portrait_hash(cropped)
+        dup = self.find_duplicate_portrait(phash, exclude=filename)
+        if dup and not messagebox.askyesno(
+            "Possible Duplicate",
+            f"This portrait looks nearly identical to the portrait of {dup}. Save anyway?"
+        ):
+            return False
+        save_path = os.path.join(self.data_dir, "images", filename)
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        # Keep the replaced portrait in the trash so the change can be undone
+        files = []
+        if self.image_exists(save_path):
+            files.append((save_path, self.trash_image(save_path)))
+        cropped.save(save_path)
+        self.index_image(save_path)
+        self.portrait_hashes[filename] = [os.path.getmtime(save_path), f"{phash:016x}"]
+        files.append((os.path.join(self.trash_dir, f"{uuid.uuid4().hex}.png"), save_path))
+
+        self.commit(
+            "portrait change",
+            [self.set_op(char, image=save_path, modified=time.time())],
+            [self.set_op(char, image=char.get("image"), modified=char.get("modified"))],
+            files
+        )
+        self.select_character(self.current_index)
+        return True
+
+    def portrait_owners(self):
+        # image filename -> "'Name' (Gallery)"
+        owners = {}
+        for g in self.galleries:
+            for char in g["characters"]:
+                if char.get("image"):
+                    owners[os.path.basename(char["image"])] = f"'{char.get('name', '')}' ({g['name']})"
+        return owners
+
+    def find_duplicate_portrait(self, phash, exclude=None):
+        names = [n for n in self.portrait_hashes if n != exclude]
+        if not names:
+            return None
+        dist = hamming_distances(phash, [int(self.portrait_hashes[n][1], 16) for n in names])
+        best = int(np.argmin(dist))
+        if dist[best] > PHASH_THRESHOLD:
+            return None
+        return self.portrait_owners().get(names[best], names[best])
+
+    def start_portrait_scan(self, report=True):
+        if self.portrait_scan is not None:
+            if report:
+                self.portrait_scan["report"] = True
+                self.set_status("Portrait scan already running...")
+            return
+        job = {"report": report, "result": None}
+        images_dir = os.path.join(self.data_dir, "images")
+        cache = dict(self.portrait_hashes)
+
+        def work():
+            job["result"] = scan_portrait_hashes(images_dir, cache)
+            job["clusters"] = duplicate_clusters({n: int(v[1], 16) for n, v in job["result"].items()})
+
+        job["thread"] = threading.Thread(target=work, daemon=True)
+        self.portrait_scan = job
+        job["thread"].start()
+        if report:
+            self.status_label.config(text="Scanning portraits for duplicates...", fg="#FFD700")
+        self.after(200, self.poll_portrait_scan)
+
+    def poll_portrait_scan(self):
+        job = self.portrait_scan
+        if job["thread"].is_alive():
+            self.after(200, self.poll_portrait_scan)
+            return
+        self.portrait_scan = None
+        if job["result"] is None:
+            return
+        # Keep hashes of portraits saved while the scan was running
+        self.portrait_hashes = {**job["result"], **{n: v for n, v in self.portrait_hashes.items()
+                                                    if n not in job["result"] and
+                                                    os.path.exists(os.path.join(self.data_dir, "images", n))}}
+        try:
+            with open(self.hash_cache_file, 'w', encoding='utf-8') as f:
+                json.dump(self.portrait_hashes, f)
+        except OSError:
+            pass
+        if job["report"]:
+            self.show_duplicate_report(job["clusters"])
+
+    def _indexed_name(self, path):
+        # Filename key in image_index, or None for paths outside the images directory
+        if os.path.normcase(os.path.abspath(os.path.dirname(path))) != os.path.normcase(os.path.abspath(self.images_dir)):
+            return None
+        return os.path.basename(path)
+
+    def image_exists(self, path):
+        if not path:
+            return False
+        name = self._indexed_name(path)
+        if self.image_index is None or name is None:
+            return os.path.exists(path)
+        return name in self.image_index
+
+    def index_image(self, path):
+        name = self._indexed_name(path)
+        if name is None:
+            return
+        if self.image_index is not None:
+            self.image_index[name] = os.path.getsize(path)
+        if self.integrity_scan is not None:
+            self.integrity_scan["touched"].add(name)
+
+    def reindex_image(self, path):
+        # For portraits another instance saved or removed, which the cached index hasn't seen
+        if path and os.path.exists(path):
+            self.index_image(path)
+        elif path:
+            self.forget_image(path)
+
+    def forget_image(self, path):
+        name = self._indexed_name(path)
+        if name is None:
+            return
+        if self.image_index is not None:
+            self.image_index.pop(name, None)
+        if self.integrity_scan is not None:
+            self.integrity_scan["touched"].add(name)
+
+    def remove_image(self, path):
+        if self.image_exists(path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.forget_image(path)
+
+    def start_integrity_scan(self):
+        if self.integrity_scan is not None:
+            return
+        referenced = self.referenced_images()
+        job = {"touched": set(), "result": None}
+        images_dir = self.images_dir
+        started = time.time()
+
+        def work():
+            index = scan_images(images_dir)
+            # Recent files may belong to a portrait being saved here or by another instance
+            orphans = [name for name, (_, mtime) in index.items()
+                       if name.lower().endswith(".png") and name not in referenced and mtime < started - ORPHAN_MIN_AGE]
+            job["result"] = ({name: size for name, (size, _) in index.items()}, orphans)
+
+        job["thread"] = threading.Thread(target=work, daemon=True)
+        self.integrity_scan = job
+        job["thread"].start()
+        self.after(200, self.poll_integrity_scan)
+
+    def referenced_images(self):
+        # Portraits referenced only by another instance's recent changes must not look orphaned
+        with self.lock:
+            conflicts = self.sync_external()[1]
+        self.report_conflicts(conflicts)
+        referenced = set()
+        for g in self.galleries:
+            for char in g["characters"]:
+                name = char.get("image") and self._indexed_name(char["image"])
+                if name:
+                    referenced.add(name)
+        return referenced
+
+    def poll_integrity_scan(self):
+        job = self.integrity_scan
+        if job["thread"].is_alive():
+            self.after(200, self.poll_integrity_scan)
+            return
+        self.integrity_scan = None
+        if job["result"] is None:
+            return
+        index, orphans = job["result"]
+        reclaimed, freed = 0, 0
+        # Files restored by undo or copied in by an import while the scan ran keep their old mtime,
+        # so candidates are only deleted here, against the references as they are now
+        with self.lock:
+            referenced = self.referenced_images()
+            for name in orphans:
+                if name in job["touched"] or name in referenced:
+                    continue
+                try:
+                    os.remove(os.path.join(self.images_dir, name))
+                except OSError:
+                    continue
+                reclaimed += 1
+                freed += index.pop(name, 0)
+                self.portrait_hashes.pop(name, None)
+        for name in job["touched"]:
+            path = os.path.join(self.images_dir, name)
+            if os.path.exists(path):
+                index[name] = os.path.getsize(path)
+            else:
+                index.pop(name, None)
+        self.image_index = index
+        # Repair records pointing at portraits that no longer exist
+        ops = []
+        for g in self.galleries:
+            items = []
+            for char in g["characters"]:
+                path = char.get("image")
+                if not path or self.image_exists(path):
+                    continue
+                if os.path.exists(path):
+                    # Saved by another instance after the scan listed the folder
+                    self.index_image(path)
+                else:
+                    items.append([char["id"], {"image": None}])
+            if items:
+                ops.append({"op": "set", "g": g["id"], "items": items})
+        repaired = sum(len(op["items"]) for op in ops)
+        if ops:
+            apply_gallery_ops(self.galleries, ops)
+            self.persist_ops(ops)
+            if self.current_index is not None:
                 self.select_character(self.current_index)
-                self.set_status("Portrait updated successfully ✔️")
+        self.set_status(
+            f"Storage check: reclaimed {reclaimed} orphaned image(s) ({freed / 1024:.1f} KB), "
+            f"repaired {repaired} missing portrait reference(s) ✔️"
+        )
+
+    def show_duplicate_report(self, clusters):
+        if not clusters:
+            self.set_status("No duplicate portraits found ✔️")
+            return
+        owners = self.portrait_owners()
+        win = tk.Toplevel(self)
+        win.title("Duplicate Portraits")
+        win.geometry("600x400")
+        win.configure(bg="#2e2e2e")
+        text = tk.Text(win, wrap="word", bg="#1e1e1e", fg="#eeeeee", font=("Arial", 10))
+        text.pack(fill="both", expand=True, padx=10, pady=10)
+        for i, cluster in enumerate(clusters, 1):
+            text.insert(tk.END, f"Group {i}:\n")
+            for name in cluster:
+                text.insert(tk.END, f"    {owners.get(name, name + ' (no character)')}\n")
+            text.insert(tk.END, "\n")
+        text.config(state="disabled")
+        self.set_status(f"Found {len(clusters)} group(s) of duplicate portraits")
 
     def on_tags_change(self, event=None):
         if self.current_index is not None:
             tags_str = self.tags_text.get("1.0", tk.END).strip()
             tags = [t.strip() for t in tags_str.split(',') if t.strip()]
-            self.current_gallery["characters"][self.current_index]['tags'] = tags
-            self.current_gallery["characters"][self.current_index]['modified'] = time.time()
+            char = self.current_gallery["characters"][self.current_index]
+            self.mark_pending(char, 'tags')
+            char['tags'] = tags
+            char['modified'] = time.time()
             self.dirty = True
 
     def on_dna_change(self, event=None):
         if self.current_index is not None:
-            self.current_gallery["characters"][self.current_index]['dna'] = self.dna_text.get("1.0", tk.END).strip()
-            self.current_gallery["characters"][self.current_index]['modified'] = time.time()
+            char = self.current_gallery["characters"][self.current_index]
+            self.mark_pending(char, 'dna')
+            char['dna'] = self.dna_text.get("1.0", tk.END).strip()
+            char['modified'] = time.time()
             self.dirty = True
+            self.reindex_dna(self.current_gallery, [(char['id'], char['dna'])])
 
     def save_current(self):
         if self.current_index is not None:
@@ -797,19 +1945,459 @@ class CharacterGallery(tk.Tk):
 
     def homogenize_dna(self):
         text = self.dna_text.get("1.0", tk.END)
-        import re
-        pattern = re.compile(r'^(\s*[\w_]+\s*=\s*\{\s*)("[^"]+"|\d+)\s+(\d+)\s+("[^"]+"|\d+)\s+(\d+)\s*(\})', re.MULTILINE)
-        def repl(m):
-            return f"{m.group(1)}{m.group(2)} {m.group(3)} {m.group(2)} {m.group(3)} {m.group(6)}"
-        new = pattern.sub(repl, text)
+        new = homogenize_text(text)
         self.dna_text.delete("1.0", tk.END)
         self.dna_text.insert(tk.END, new)
         if self.current_index is not None:
-            self.current_gallery["characters"][self.current_index]['dna'] = new.strip()
-            self.current_gallery["characters"][self.current_index]['modified'] = time.time()
+            char = self.current_gallery["characters"][self.current_index]
+            self.mark_pending(char, 'dna')
+            char['dna'] = new.strip()
+            char['modified'] = time.time()
             self.dirty = True
+            self.reindex_dna(self.current_gallery, [(char['id'], char['dna'])])
         self.set_status("DNA homogenized ✔️")
 
+    def open_batch_transform(self):
+        # With a search filter active, rows are not gallery positions
+        selected = [self.listed_chars[i] for i in self.char_listbox.curselection()]
+        dialog = BatchTransformDialog(self, [c.get("name", "") for c in self.current_gallery["characters"]], bool(selected))
+        self.wait_window(dialog)
+        if not dialog.result:
+            return
+        scope, ops = dialog.result
+        chars = self.current_gallery["characters"]
+        if scope == "selected":
+            targets = selected
+        elif scope == "gallery":
+            targets = list(chars)
+        else:
+            targets = [c for g in self.galleries for c in g["characters"]]
+        self.run_batch_transform(targets, ops)
+
+    def run_batch_transform(self, targets, ops):
+        if self.batch_job is not None:
+            messagebox.showwarning("Warning", "A batch transform is already running.")
+            return
+        targets = [c for c in targets if self.get_dna(c)]
+        if not targets:
+            return
+        work = [(c["id"], c["dna"]) for c in targets]
+        job = {"targets": {c["id"]: c for c in targets}, "inputs": dict(work), "results": [], "total": len(work)}
+        self.batch_job = job
+        if len(work) < BATCH_PROCESS_THRESHOLD:
+            job["results"] = transform_chunk(work, ops)
+            self.finish_batch_transform()
+            return
+        # Background scan and index threads may be running, and forking a threaded process can deadlock the workers
+        job["pool"] = ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"))
+        job["futures"] = [job["pool"].submit(transform_chunk, work[i:i + BATCH_CHUNK_SIZE], ops)
+                          for i in range(0, len(work), BATCH_CHUNK_SIZE)]
+        self.poll_batch_transform()
+
+    def poll_batch_transform(self):
+        job = self.batch_job
+        pending = []
+        for fut in job["futures"]:
+            if not fut.done():
+                pending.append(fut)
+                continue
+            try:
+                job["results"].extend(fut.result())
+            except Exception as e:
+                # A worker died (e.g. BrokenProcessPool): nothing is applied, the batch can be run again
+                job["pool"].shutdown(wait=False, cancel_futures=True)
+                self.batch_job = None
+                self.status_label.config(text=f"Batch transform failed: {e}", fg="#FF5555")
+                self.after(5000, lambda: self.status_label.config(text="Idle", fg="#888888"))
+                return
+        job["futures"] = pending
+        if pending:
+            self.status_label.config(text=f"Transforming DNA... {len(job['results'])}/{job['total']}", fg="#FFD700")
+            self.after(100, self.poll_batch_transform)
+            return
+        job["pool"].shutdown()
+        self.finish_batch_transform()
+
+    def finish_batch_transform(self):
+        job, self.batch_job = self.batch_job, None
+        now = time.time()
+        changed, skipped = {}, 0
+        for key, new in job["results"]:
+            char = job["targets"][key]
+            if self.get_dna(char) != job["inputs"][key]:
+                # Edited here or by another instance while the workers ran, keep that edit
+                skipped += 1
+            elif new != char["dna"]:
+                changed[id(char)] = new
+        # One set op per gallery, the whole batch is a single undo step and a single write
+        redo, undo = [], []
+        for g in self.galleries:
+            items = [(c, changed[id(c)]) for c in g["characters"] if id(c) in changed]
+            if items:
+                redo.append({"op": "set", "g": g["id"], "items": [[c["id"], {"dna": new, "modified": now}] for c, new in items]})
+                undo.append({"op": "set", "g": g["id"], "items": [[c["id"], {"dna": c["dna"], "modified": c.get("modified")}]
+                                                                  for c, _ in items]})
+        if redo:
+            self.commit("batch transform", redo, undo)
+            if self.current_index is not None:
+                self.select_character(self.current_index)
+        note = f", skipped {skipped} edited while it ran" if skipped else ""
+        self.set_status(f"Batch transform changed {len(changed)} of {job['total']} character DNA(s){note} ✔️")
+
+    def gallery_index(self, gallery=None):
+        gallery = gallery or self.current_gallery
+        return next(i for i, g in enumerate(self.galleries) if g is gallery)
+
+    def gallery_by_id(self, gid):
+        pos = gallery_position(self.galleries, gid)
+        return None if pos is None else self.galleries[pos]
+
+    def set_op(self, char, **fields):
+        return {"op": "set", "g": self.current_gallery["id"], "items": [[char["id"], fields]]}
+
+    def commit(self, label, redo, undo, files=()):
+        """Apply redo ops, push the change onto the undo log and persist it.
+        files are (undo_path, redo_path) pairs: where each trashed or replaced portrait lives before/after the change."""
+        apply_gallery_ops(self.galleries, redo)
+        self.reindex_ops(redo)
+        delta = {"label": label, "redo": redo, "undo": undo, "files": list(files),
+                 "view": self.current_gallery, "size": estimate_size(redo) + estimate_size(undo)}
+        for old in self.redo_stack:
+            self.history_bytes -= old["size"]
+            self.purge_trash(old)
+        self.redo_stack = []
+        self.undo_stack.append(delta)
+        self.history_bytes += delta["size"]
+        while self.history_bytes > UNDO_MEMORY_LIMIT and len(self.undo_stack) > 1:
+            old = self.undo_stack.popleft()
+            self.history_bytes -= old["size"]
+            self.purge_trash(old)
+        self.persist_ops(redo)
+
+    def on_history_key(self, action):
+        # Text boxes keep their own undo
+        if not isinstance(self.focus_get(), tk.Text):
+            action()
+
+    def undo(self):
+        if not self.undo_stack:
+            self.set_status("Nothing to undo")
+            return
+        delta = self.undo_stack.pop()
+        for undo_path, redo_path in reversed(delta["files"]):
+            self.move_image(redo_path, undo_path)
+        apply_gallery_ops(self.galleries, delta["undo"])
+        self.reindex_ops(delta["undo"])
+        self.redo_stack.append(delta)
+        self.persist_ops(delta["undo"])
+        self.refresh_after_history(delta)
+        self.set_status(f"Undid {delta['label']} ✔️")
+
+    def redo(self):
+        if not self.redo_stack:
+            self.set_status("Nothing to redo")
+            return
+        delta = self.redo_stack.pop()
+        for undo_path, redo_path in delta["files"]:
+            self.move_image(undo_path, redo_path)
+        apply_gallery_ops(self.galleries, delta["redo"])
+        self.reindex_ops(delta["redo"])
+        self.undo_stack.append(delta)
+        self.persist_ops(delta["redo"])
+        self.refresh_after_history(delta)
+        self.set_status(f"Redid {delta['label']} ✔️")
+
+    def refresh_after_history(self, delta):
+        cur = self.current_gallery["characters"][self.current_index] if self.current_index is not None else None
+        if any(g is delta["view"] for g in self.galleries):
+            self.current_gallery = delta["view"]
+        elif not any(g is self.current_gallery for g in self.galleries):
+            self.current_gallery = self.galleries[0]
+        self.gallery_box["values"] = [g["name"] for g in self.galleries] + ["Create a new gallery..."]
+        self.gallery_var.set(self.current_gallery["name"])
+        self.refresh_list()
+        chars = self.current_gallery["characters"]
+        index = next((i for i, c in enumerate(chars) if c is cur), None)
+        if index is None:
+            self.clear_character_view()
+        else:
+            self.char_listbox.selection_set(index)
+            self.select_character(index)
+
+    def clear_character_view(self):
+        if self.portrait_image_id:
+            self.portrait_canvas.delete(self.portrait_image_id)
+        self.portrait_image_id = None
+        self.dna_text.delete("1.0", tk.END)
+        self.tags_text.delete("1.0", tk.END)
+        self.current_index = None
+
+    def move_image(self, src, dst):
+        if not os.path.exists(src):
+            return
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        os.replace(src, dst)
+        self.forget_image(src)
+        self.index_image(dst)
+        for path in (src, dst):
+            self.portrait_hashes.pop(os.path.basename(path), None)
+
+    def trash_image(self, path):
+        dst = os.path.join(self.trash_dir, f"{uuid.uuid4().hex}.png")
+        self.move_image(path, dst)
+        return dst
+
+    def trash_images(self, chars):
+        return [(c["image"], self.trash_image(c["image"])) for c in chars if self.image_exists(c.get("image"))]
+
+    def trash_abandoned(self, path):
+        owner = os.path.join(path, "owner.lock")
+        if not os.path.exists(owner):
+            # Just created by a starting instance, or left by a version without owner locks
+            return os.stat(path).st_mtime < time.time() - TRASH_MAX_AGE
+        try:
+            with FileLock(owner, blocking=False):
+                return True
+        except OSError:
+            return False
+
+    def purge_trash(self, delta):
+        # The delta can no longer be undone or redone, so whatever it parked in the trash is gone for good
+        for pair in delta["files"]:
+            for path in pair:
+                if os.path.dirname(path) == self.trash_dir and os.path.exists(path):
+                    os.remove(path)
+
+    def persist_ops(self, ops):
+        """Append ops to the journal, falling back to a full save when other edits are pending."""
+        with self.lock:
+            synced, conflicts = self.sync_external()
+            if synced:
+                # A merge may have overwritten what these ops changed in memory
+                apply_gallery_ops(self.galleries, ops)
+                self.reindex_ops(ops)
+            if self.dirty or self.journal_length >= JOURNAL_LIMIT or not os.path.exists(self.data_file):
+                self.save_galleries()
+            else:
+                with open(self.journal_file, 'a', encoding='utf-8') as f:
+                    if self.journal_offset == 0:
+                        f.write(json.dumps({"op": "base", **self.disk_stamp}) + "\n")
+                    for op in ops:
+                        f.write(json.dumps(op, separators=(',', ':')) + "\n")
+                self.journal_length += len(ops)
+                self.journal_offset = os.path.getsize(self.journal_file)
+        self.report_conflicts(conflicts)
+
+    def data_file_stamp(self):
+        st = os.stat(self.data_file)
+        return {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+
+    def read_journal(self, offset, stamp):
+        """Ops appended after byte offset and the offset they end at; ops is None if the journal
+        belongs to another version of galleries.json than stamp."""
+        if not os.path.exists(self.journal_file):
+            return [], 0
+        with open(self.journal_file, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        # A torn last line is still being written (or was cut by a crash), leave it for next time
+        end = data.rfind(b"\n") + 1
+        lines = data[:end].decode('utf-8').splitlines()
+        if offset == 0:
+            if not lines:
+                return [], 0
+            try:
+                header = json.loads(lines[0])
+            except ValueError:
+                header = {}
+            if header.get("op") != "base" or {k: header.get(k) for k in ("mtime_ns", "size")} != stamp:
+                return None, 0
+            lines = lines[1:]
+        ops = []
+        for line in lines:
+            try:
+                ops.append(json.loads(line))
+            except ValueError:
+                break
+        return ops, offset + end
+
+    def external_change(self):
+        """"full" if another instance rewrote galleries.json, "tail" if it only appended to the journal."""
+        stamp = self.data_file_stamp() if os.path.exists(self.data_file) else None
+        if stamp != self.disk_stamp:
+            return "full"
+        size = os.path.getsize(self.journal_file) if os.path.exists(self.journal_file) else 0
+        return "tail" if size != self.journal_offset else None
+
+    def sync_external(self):
+        """Merge changes written by other instances into memory, record by record. Caller holds self.lock.
+        Returns (whether anything was merged, conflicts with unsaved edits here)."""
+        kind = self.external_change()
+        if kind is None:
+            return False, []
+        # Unsaved edits on characters deleted here since are moot
+        self.pending = {key: entry for key, entry in self.pending.items()
+                        if any(g is entry["gallery"] for g in self.galleries)
+                        and any(c is entry["char"] for c in entry["gallery"]["characters"])}
+        ours = [(entry, {f: entry["char"].get(f) for f in entry["base"]}) for entry in self.pending.values()]
+        cur = self.current_gallery["characters"][self.current_index] if self.current_index is not None else None
+        snapshot = dict(cur) if cur is not None else None
+        before = list(self.current_gallery["characters"]) if self.current_gallery else []
+        changed = set()
+        if kind == "tail":
+            # Only the journal grew: replay just the new ops
+            ops, offset = self.read_journal(self.journal_offset, self.disk_stamp)
+            if ops is None:
+                kind = "full"
+        if kind == "tail":
+            apply_gallery_ops(self.galleries, ops)
+            self.reindex_ops(ops)
+            self.journal_length += len(ops)
+            self.journal_offset = offset
+            for op in ops:
+                gallery = self.gallery_by_id(op["g"]) if op["op"] == "set" else None
+                if gallery is not None:
+                    chars = {c.get("id"): c for c in gallery["characters"]}
+                    changed.update(id(chars[cid]) for cid, _ in op["items"] if cid in chars)
+                    images = [fields["image"] for _, fields in op["items"] if "image" in fields]
+                elif op["op"] == "insert":
+                    images = [char.get("image") for _, char in op["items"]]
+                elif op["op"] == "add_gallery":
+                    images = [char.get("image") for char in op["gallery"]["characters"]]
+                else:
+                    images = []
+                for path in images:
+                    self.reindex_image(path)
+        else:
+            # Undecoded records are compressed against our vocabulary, which may be about to change
+            for g in self.galleries:
+                for char in g["characters"]:
+                    self.get_dna(char)
+            store = self.read_store()
+            galleries, store["galleries"] = store["galleries"], self.galleries
+            # The storage format is this instance's setting, the next write uses it
+            store["compact"] = self.compact_dna
+            self.load_store(store)
+            # Unsaved edits bump "modified": judge those records by what they were before the edit
+            signatures = {id(entry["char"]): record_signature(dict(entry["char"], **entry["base"]))
+                          for entry in self.pending.values()}
+            records = merge_galleries(self.galleries, galleries, signatures)
+            by_gallery = {}
+            for g, char in records:
+                changed.add(id(char))
+                self.reindex_image(char.get("image"))
+                by_gallery.setdefault(id(g), (g, []))[1].append((char.get("id"), self.get_dna(char)))
+            for g, items in by_gallery.values():
+                self.reindex_dna(g, items)
+        conflicts = self.restore_pending(ours)
+        if cur is not None and id(cur) in changed:
+            self.get_dna(cur)
+            if cur == snapshot:
+                # Only our own unsaved values came back, the boxes being typed in are already current
+                changed.discard(id(cur))
+        self.refresh_after_sync(changed, before, cur)
+        return True, conflicts
+
+    def mark_pending(self, char, field):
+        # Remember the value an unsaved edit replaced, to tell another instance's change from our own
+        entry = self.pending.setdefault(id(char), {"char": char, "gallery": self.current_gallery,
+                                                   "base": {"modified": char.get("modified")}})
+        entry["base"].setdefault(field, char.get(field))
+
+    def restore_pending(self, ours):
+        """Re-apply unsaved edits on top of merged records. Where the other instance changed the same
+        field, or deleted the character, ours is kept for now and a conflict is returned."""
+        conflicts = []
+        for entry, local in ours:
+            gallery, char, base = entry["gallery"], entry["char"], entry["base"]
+            if not any(g is gallery for g in self.galleries):
+                # Whole gallery deleted elsewhere, bring back just the characters with unsaved edits
+                gallery["characters"][:] = []
+                self.galleries.append(gallery)
+            current = next((c for c in gallery["characters"] if c.get("id") == char.get("id")), None)
+            if current is None:
+                gallery["characters"].append(char)
+                conflicts.append({"gallery": gallery, "char": char, "theirs": None})
+                continue
+            self.get_dna(current)
+            entry["char"] = current
+            theirs = {f: current.get(f) for f in local}
+            clash = any(theirs[f] != base[f] and theirs[f] != local[f] for f in local if f != "modified")
+            current.update(local)
+            if "dna" in local and theirs["dna"] != local["dna"]:
+                # The merge indexed their DNA
+                self.reindex_dna(gallery, [(current.get("id"), local["dna"])])
+            if clash:
+                conflicts.append({"gallery": gallery, "char": current, "theirs": theirs})
+        return conflicts
+
+    def refresh_after_sync(self, changed, before, cur):
+        """Redraw only what a merge touched: changed rows in place, the whole list only if membership or order moved."""
+        names = [g["name"] for g in self.galleries] + ["Create a new gallery..."]
+        if list(self.gallery_box["values"]) != names:
+            self.gallery_box["values"] = names
+        if not any(g is self.current_gallery for g in self.galleries):
+            self.current_gallery = self.galleries[0]
+        self.gallery_var.set(self.current_gallery["name"])
+        chars = self.current_gallery["characters"]
+        structural = len(chars) != len(before) or any(a is not b for a, b in zip(chars, before))
+        filtering = bool(self.search_var.get().strip())
+        if filtering:
+            self.filter_list()
+        elif structural:
+            self.refresh_list()
+        else:
+            for i, char in enumerate(chars):
+                if id(char) in changed:
+                    self.char_listbox.delete(i)
+                    self.char_listbox.insert(i, char.get("name", ""))
+        index = next((i for i, c in enumerate(chars) if c is cur), None) if cur is not None else None
+        if index is None:
+            if cur is not None:
+                self.clear_character_view()
+        else:
+            # Filtered rows don't line up with gallery positions, leave the list unselected there
+            if not filtering:
+                self.char_listbox.selection_set(index)
+            if id(cur) in changed:
+                self.select_character(index)
+            elif structural:
+                # Same record at a new position, keep the boxes as they are
+                self.current_index = index
+
+    def poll_external_changes(self):
+        # Stay out of the way while a dialog is open, its caller may be holding a list index
+        if self.grab_current() is None:
+            try:
+                if self.external_change():
+                    with self.lock:
+                        conflicts = self.sync_external()[1]
+                    self.report_conflicts(conflicts)
+            except OSError:
+                pass
+        self.after(EXTERNAL_POLL_MS, self.poll_external_changes)
+
+    def report_conflicts(self, conflicts):
+        if conflicts:
+            self.after_idle(lambda: self.resolve_conflicts(conflicts))
+
+    def resolve_conflicts(self, conflicts):
+        dialog = ConflictDialog(self, conflicts)
+        self.wait_window(dialog)
+        if not dialog.result:
+            return
+        for conflict in dialog.result:
+            gallery, char = conflict["gallery"], conflict["char"]
+            self.pending.pop(id(char), None)
+            if conflict["theirs"] is None:
+                gallery["characters"][:] = [c for c in gallery["characters"] if c is not char]
+            else:
+                char.update(conflict["theirs"])
+        self.dirty = True
+        self.save_galleries()
+        self.refresh_after_history({"view": self.current_gallery})
+        self.set_status(f"Took the other version of {len(dialog.result)} character(s) ✔️")
+
     def copy_dna(self):
         data = self.dna_text.get("1.0", tk.END).strip()
         if data:
@@ -820,5 +2408,7 @@ class CharacterGallery(tk.Tk):
             messagebox.showinfo("Info", "No DNA to copy.")
 
 if __name__ == "__main__":
+    # Needed for batch transform workers in frozen (pyinstaller) builds
+    multiprocessing.freeze_support()
     app = CharacterGallery()
     app.mainloop()